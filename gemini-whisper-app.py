@@ -6,10 +6,27 @@ import json
 import os
 import sys
 import threading
-from datetime import date
+import asyncio
+from datetime import date, timedelta
 import time
 import traceback
 
+# --- Config Serialization (orjson if installed, stdlib json otherwise) ---
+try:
+    import orjson
+
+    def config_loads(text):
+        return orjson.loads(text)
+
+    def config_dumps(obj):
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2).decode()
+except ImportError:
+    def config_loads(text):
+        return json.loads(text)
+
+    def config_dumps(obj):
+        return json.dumps(obj, indent=2, ensure_ascii=False) # Same text as orjson's OPT_INDENT_2, non-ASCII included
+
 # --- System Tray Imports ---
 try:
     import pystray
@@ -35,25 +52,221 @@ except pygame.error as e:
     PYGAME_MIXER_AVAILABLE = False
 
 # --- Existing Dictation Imports ---
-import google.generativeai as genai
-import sounddevice as sd
-import soundfile as sf
 import numpy as np
 import keyboard
-import pyautogui
 import io
-from scipy import signal
+import struct
+import functools
+import importlib.util
+
+# --- Deferred Heavy Imports ---
+# These modules are slow to import and not needed until the first dictation. They are loaded on first
+# use through the accessors below and preloaded on a background thread at startup, so the window
+# appears without waiting for them.
+genai = None
+google_exceptions = None
+sd = None
+signal = None
+pyautogui = None
+
+
+def _genai():
+    global genai, google_exceptions
+    if genai is None:
+        import google.generativeai.caching
+        from google.api_core import exceptions as google_exceptions
+        import google.generativeai as genai
+    return genai
+
+
+def _sd():
+    global sd
+    if sd is None:
+        import sounddevice as sd
+    return sd
+
+
+def _signal():
+    global signal
+    if signal is None:
+        from scipy import signal
+    return signal
+
+
+def _pyautogui():
+    global pyautogui
+    if pyautogui is None:
+        import pyautogui
+    return pyautogui
+
+
+# --- Optional JIT Acceleration for Audio Processing ---
+NUMBA_AVAILABLE = importlib.util.find_spec("numba") is not None # Cleared by _run_jit if numba turns out unusable
+if not NUMBA_AVAILABLE:
+    print("Note: 'numba' not found. Falling back to SciPy/NumPy for audio processing.")
+    print("Install it with: pip install numba")
 
 # --- Configuration File ---
 CONFIG_FILE = "dictation_config.json"
+CONFIG_SAVE_DEBOUNCE_MS = 2000 # Saves requested within this window (e.g. API stat updates) are written once
 FIXED_HOTKEY = "ctrl+alt+d"
 ICON_PATH = "icon.png" # Path to your icon image, should be in the same dir as script
 
+# --- Text Insertion ---
+PASTE_HOTKEY = "command+v" if sys.platform == "darwin" else "ctrl+v"
+CLIPBOARD_RESTORE_DELAY_MS = 300 # Time the target app gets to read the clipboard before it's restored
+
 # --- Sound Files (MP3s are fine with pygame) ---
 SOUND_ASSETS_DIR = "assets"
 SOUND_DICTATION_STARTED = os.path.join(SOUND_ASSETS_DIR, "dictation_started.mp3")
 SOUND_DICTATION_STOPPED = os.path.join(SOUND_ASSETS_DIR, "dictation_stopped.mp3")
 
+# --- Audio Processing ---
+SAMPLE_RATE = 16000
+AUDIO_CHANNELS = 1 # Multichannel input is downmixed to mono as it's recorded
+HIGHPASS_CUTOFF_HZ = 100.0
+AUDIO_BLOCKSIZE = 1600 # 100 ms per callback at 16 kHz
+MAX_RECORDING_SECONDS = 300 # Recording buffer size; recording stops automatically once it is full
+VAD_FRAME_SAMPLES = 320 # 20 ms frames for silence detection
+SILENCE_THRESHOLD_DBFS = -40.0
+SPEECH_PADDING_SECONDS = 0.1 # Kept around detected speech so soft onsets/endings aren't clipped
+MIN_SPEECH_SECONDS = 0.3 # Recordings (and speech after trimming) shorter than this are not sent to the API
+SILENT_RECORDING_DBFS = -50.0 # Recordings quieter than this overall are rejected before any processing
+INLINE_AUDIO_MAX_SECONDS = 2.0 # Shorter clips are sent inline; longer ones go through the Files API
+
+# Plain-Python kernels below are only ever run compiled, through _run_jit.
+def _hpf_sos(x, sos):
+    # Biquad cascade in direct form II transposed, filtering x in place.
+    for s in range(sos.shape[0]):
+        b0, b1, b2 = sos[s, 0], sos[s, 1], sos[s, 2]
+        a1, a2 = sos[s, 4], sos[s, 5]
+        z1 = 0.0
+        z2 = 0.0
+        for n in range(x.shape[0]):
+            xn = x[n]
+            yn = b0 * xn + z1
+            z1 = b1 * xn - a1 * yn + z2
+            z2 = b2 * xn - a2 * yn
+            x[n] = yn
+    return x
+
+
+def _speech_frame_bounds_loop(x, frame, threshold_power):
+    # Single pass over x; returns (first, last + 1) of frames above threshold_power, or (0, 0).
+    first = -1
+    last = -1
+    min_energy = threshold_power * frame
+    for f in range(x.shape[0] // frame):
+        energy = 0.0
+        for n in range(f * frame, (f + 1) * frame):
+            energy += x[n] * x[n]
+        if energy > min_energy:
+            if first < 0:
+                first = f
+            last = f
+    if first < 0:
+        return 0, 0
+    return first, last + 1
+
+
+def _speech_frame_bounds_numpy(x, frame, threshold_power):
+    n_frames = x.shape[0] // frame
+    frame_power = np.square(x[:n_frames * frame].reshape(n_frames, frame)).mean(axis=1)
+    active = np.flatnonzero(frame_power > threshold_power)
+    if active.size == 0:
+        return 0, 0
+    return int(active[0]), int(active[-1]) + 1
+
+
+_JIT_KERNELS = {}
+
+
+def _run_jit(kernel, *args):
+    # Runs the numba-compiled kernel (compiled, or loaded from numba's cache, on first use) and returns its result.
+    # Returns None if numba is missing or fails to import or compile (e.g. a NumPy version it doesn't support);
+    # NUMBA_AVAILABLE is then cleared so callers use their SciPy/NumPy path from here on.
+    global NUMBA_AVAILABLE
+    if not NUMBA_AVAILABLE:
+        return None
+    try:
+        compiled = _JIT_KERNELS.get(kernel)
+        if compiled is None:
+            from numba import njit
+            compiled = _JIT_KERNELS[kernel] = njit(cache=True, fastmath=True)(kernel)
+        return compiled(*args) # njit compiles lazily, so compile errors surface on this first call
+    except Exception as e:
+        NUMBA_AVAILABLE = False
+        print(f"Note: 'numba' is unusable ({e}). Falling back to SciPy/NumPy for audio processing.")
+        return None
+
+
+@functools.lru_cache(maxsize=None)
+def highpass_sos():
+    # 4th-order Butterworth high-pass in second-order sections, designed once since cutoff and rate are fixed.
+    return _signal().butter(4, HIGHPASS_CUTOFF_HZ / (SAMPLE_RATE / 2.0), btype='highpass', analog=False, output='sos')
+
+
+def apply_highpass_filter(audio_data):
+    # The JIT path filters audio_data in place.
+    filtered = _run_jit(_hpf_sos, audio_data, highpass_sos())
+    if filtered is not None:
+        return filtered
+    return _signal().sosfilt(highpass_sos(), audio_data)
+
+
+def trim_silence(audio_data):
+    # Returns the view of audio_data from the first to the last frame louder than SILENCE_THRESHOLD_DBFS.
+    threshold_power = 10.0 ** (SILENCE_THRESHOLD_DBFS / 10.0)
+    bounds = _run_jit(_speech_frame_bounds_loop, audio_data, VAD_FRAME_SAMPLES, threshold_power)
+    if bounds is None:
+        bounds = _speech_frame_bounds_numpy(audio_data, VAD_FRAME_SAMPLES, threshold_power)
+    first, last = bounds
+    if first == last:
+        return audio_data[:0]
+    padding = int(SPEECH_PADDING_SECONDS * SAMPLE_RATE)
+    start = max(0, first * VAD_FRAME_SAMPLES - padding)
+    end = min(len(audio_data), last * VAD_FRAME_SAMPLES + padding)
+    return audio_data[start:end]
+
+
+def encode_wav_pcm16(audio_data):
+    # Encodes mono float audio in [-1, 1] as a 16-bit PCM WAV file.
+    scaled = np.multiply(audio_data, 32767.0, dtype=np.float32)
+    np.clip(scaled, -32768, 32767, out=scaled)
+    pcm = scaled.astype('<i2')
+    data_size = pcm.nbytes
+    header = struct.pack(
+        '<4sI4s4sIHHIIHH4sI',
+        b'RIFF', 36 + data_size, b'WAVE',
+        b'fmt ', 16, 1, 1, SAMPLE_RATE, SAMPLE_RATE * 2, 2, 16, # PCM, mono, 16-bit
+        b'data', data_size,
+    )
+    # join copies the header and the samples (via the array's buffer) into the output exactly once.
+    return b"".join((header, pcm.data))
+
+
+def input_stream_extra_settings():
+    # Returns shared-mode WASAPI settings if the default input device uses WASAPI, else None.
+    sd = _sd()
+    if os.name != 'nt' or not hasattr(sd, 'WasapiSettings'):
+        return None
+    try:
+        hostapi = sd.query_hostapis(sd.query_devices(kind='input')['hostapi'])
+    except Exception as e:
+        print(f"Note: Could not query input host API: {e}")
+        return None
+    if 'WASAPI' not in hostapi['name']:
+        return None
+    return sd.WasapiSettings(exclusive=False)
+
+
+def warm_up_audio_kernels():
+    # Compiles (or loads from cache) the JIT kernels so the first dictation doesn't pay for it.
+    try:
+        trim_silence(apply_highpass_filter(np.zeros(1024, dtype=np.float32)))
+    except Exception as e:
+        print(f"Warning: Audio filter warm-up failed: {e}")
+
 # --- Default Prompt ---
 COMPREHENSIVE_DEFAULT_PROMPT = (
 "Transcribe speech accurately.\n\nStrictly OMIT: All filler words (um, uh, ah, like, you know, so), hesitations, and false starts (transcribe only the corrected phrase).\nNo Speech: If audio contains no discernible words (silence, pure noise), output a completely empty string\n\n"
@@ -102,9 +315,15 @@ AVAILABLE_MODELS = [
 if DEFAULT_MODEL_CHOICE not in AVAILABLE_MODELS:
     AVAILABLE_MODELS.insert(0, DEFAULT_MODEL_CHOICE)
 
+# --- Prompt Caching ---
+PROMPT_CACHE_TTL_SECONDS = 3600
+PROMPT_CACHE_REFRESH_MARGIN_SECONDS = 60 # Recreate the cache this long before it expires server-side
+PROMPT_CACHE_MIN_PROMPT_CHARS = 4096 * 4 # Context caching rejects prompts under ~4k tokens (~4 chars each)
+
 # --- Global UI Constants ---
 APP_FONT_FAMILY = "Segoe UI" if os.name == 'nt' else ("Helvetica" if sys.platform != "darwin" else "Arial")
 APP_FONT_SIZE = 10
+TOPMOST_FALLBACK_MS = 1000 # Backstop for dropping -topmost when Windows refuses focus -force
 APP_FONT = (APP_FONT_FAMILY, APP_FONT_SIZE)
 APP_FONT_BOLD = (APP_FONT_FAMILY, APP_FONT_SIZE, "bold")
 
@@ -135,22 +354,46 @@ class DictationApp:
 
         self.settings = {}
         self.api_stats = {"daily_calls": 0, "last_call_date": str(date.today()), "total_calls": 0}
+        self.last_saved_config_text = None # What's on disk, so unchanged saves can be skipped
+        self.pending_save_id = None
 
         self.is_recording = False
-        self.audio_frames = []
+        self.audio_buffer = None
+        self.audio_buffer_pos = 0
         self.audio_stream = None
         self.hotkey_listener_active = False
-        self.hotkey_listener_thread = None
+        self.hotkey_registered = False
+
+        # API key google.generativeai was last configured with. See _configured_genai.
+        self.configured_api_key = None
+        self.genai_config_lock = threading.Lock()
+
+        # GenerativeModel instances reused across requests, keyed by (model, prompt) or by cached content name.
+        self.model_cache = {}
+
+        # Server-side cached system prompt, keyed by (model, prompt). See _get_prompt_cache.
+        self.prompt_cache = None
+        self.prompt_cache_key = None
+        self.prompt_cache_created = 0.0
+        self.prompt_cache_pending_key = None # Key currently being created on a background thread
+        self.prompt_cache_failed_key = None # Last key the server refused to cache
+        self.prompt_cache_lock = threading.Lock()
+
+        # Gemini requests run on one long-lived event loop, so the async client's connections are reused.
+        self.async_loop = asyncio.new_event_loop()
+        threading.Thread(target=self.async_loop.run_forever, daemon=True).start()
 
         # --- Tray Icon Attributes ---
         self.tray_icon = None
         self.tray_thread = None
         self.is_quitting_via_tray = False
         self.can_use_tray = PYSTRAY_AVAILABLE
+        self.topmost_until_focus = False # Set by show_window, cleared once the window gains focus
         # --- End Tray Icon Attributes ---
 
         self.start_sound_obj = None
         self.stop_sound_obj = None
+        self.cue_channel = None
         if PYGAME_MIXER_AVAILABLE:
             if os.path.exists(SOUND_DICTATION_STARTED):
                 try:
@@ -168,6 +411,16 @@ class DictationApp:
             else:
                 print(f"Warning: Stop sound file not found: {SOUND_DICTATION_STOPPED}")
 
+            # Cues always play on one reserved channel, instead of the mixer hunting for a free one each time.
+            pygame.mixer.set_reserved(1)
+            self.cue_channel = pygame.mixer.Channel(0)
+            if self.start_sound_obj:
+                # A silent play makes the mixer do its first-playback setup now rather than on the first hotkey press.
+                self.cue_channel.set_volume(0)
+                self.cue_channel.play(self.start_sound_obj)
+                self.cue_channel.stop()
+                self.cue_channel.set_volume(1.0)
+
         if not self.is_themed_app:
             self._apply_fallback_styles()
 
@@ -180,11 +433,37 @@ class DictationApp:
         else:
             self.status_var.set("Status: API Key required. Configure in settings.")
 
+        threading.Thread(target=self._preload_heavy_modules, daemon=True).start()
+
+        self.root.bind("<FocusIn>", self._clear_topmost_once)
+        self.root.bind("<Unmap>", self._clear_topmost_once)
+
         if self.can_use_tray:
-            self.root.protocol("WM_DELETE_WINDOW", self.hide_to_tray)
             self.setup_tray_icon()
-        else:
-            self.root.protocol("WM_DELETE_WINDOW", self.on_closing) # Default close if no tray
+        # With a tray, closing the window just hides it; quitting goes through the tray menu (quit_action).
+        self.root.protocol("WM_DELETE_WINDOW", self.root.withdraw if self.can_use_tray else self.on_closing)
+
+    def _preload_heavy_modules(self):
+        # Runs in the background at startup so the first hotkey press doesn't wait on imports or JIT compilation.
+        for loader in (self._configured_genai if self.settings.get("api_key") else _genai, _sd, _pyautogui):
+            try:
+                loader()
+            except Exception as e:
+                print(f"Warning: Background preload failed: {e}")
+        warm_up_audio_kernels()
+
+    def _configured_genai(self):
+        # Returns google.generativeai, configured with the current API key.
+        api_key = self.settings.get("api_key")
+        with self.genai_config_lock:
+            if self.configured_api_key != api_key:
+                _genai().configure(api_key=api_key)
+                self.configured_api_key = api_key
+        return genai
+
+    def _report_error(self, title, message, dialog=messagebox.showerror):
+        # Shows a message box from the Tk event loop; safe to call from any thread.
+        self.root.after(0, dialog, title, message)
 
     def _apply_fallback_styles(self):
         print("Applying fallback ttk styles.")
@@ -214,21 +493,23 @@ class DictationApp:
     def play_sound_async(self, sound_object_to_play):
         if PYGAME_MIXER_AVAILABLE and sound_object_to_play:
             try:
-                sound_object_to_play.play()
+                self.cue_channel.play(sound_object_to_play) # Replaces any cue still playing
             except Exception as e:
                 print(f"Error playing sound with pygame: {e}")
         elif PYGAME_MIXER_AVAILABLE and not sound_object_to_play:
             print(f"Warning: Sound object not loaded or invalid.")
 
     def load_config(self):
-        default_settings_template = {"api_key": "", "model": DEFAULT_MODEL_CHOICE, "prompt": DEFAULT_PROMPT}
+        default_settings_template = {"api_key": "", "model": DEFAULT_MODEL_CHOICE, "prompt": DEFAULT_PROMPT, "paste_via_clipboard": True}
         default_api_stats_template = {"daily_calls": 0, "last_call_date": str(date.today()), "total_calls": 0}
         if os.path.exists(CONFIG_FILE):
             try:
-                with open(CONFIG_FILE, 'r') as f:
-                    config_data = json.load(f)
-                self.settings = {**default_settings_template, **config_data.get("settings", {})}
-                self.api_stats = {**default_api_stats_template, **config_data.get("api_stats", {})}
+                with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
+                    config_text = f.read()
+                config_data = config_loads(config_text)
+                self.last_saved_config_text = config_text
+                self.settings = {**default_settings_template, **(config_data.get("settings") or {})}
+                self.api_stats = {**default_api_stats_template, **(config_data.get("api_stats") or {})}
                 today_str = str(date.today())
                 if self.api_stats.get("last_call_date") != today_str:
                     self.api_stats["daily_calls"] = 0
@@ -242,14 +523,20 @@ class DictationApp:
             self.save_config()
 
     def initialize_default_config(self):
-        self.settings = {"api_key": "", "model": DEFAULT_MODEL_CHOICE, "prompt": DEFAULT_PROMPT}
+        self.settings = {"api_key": "", "model": DEFAULT_MODEL_CHOICE, "prompt": DEFAULT_PROMPT, "paste_via_clipboard": True}
         self.api_stats = {"daily_calls": 0, "last_call_date": str(date.today()), "total_calls": 0}
 
+    def schedule_save_config(self):
+        # Saves the config CONFIG_SAVE_DEBOUNCE_MS from now, coalescing any other requests made until then.
+        if self.pending_save_id is None:
+            self.pending_save_id = self.root.after(CONFIG_SAVE_DEBOUNCE_MS, self.save_config)
+
     def save_config(self):
-        config_data = {"settings": self.settings, "api_stats": self.api_stats}
+        if self.pending_save_id is not None:
+            self.root.after_cancel(self.pending_save_id)
+            self.pending_save_id = None
         try:
-            with open(CONFIG_FILE, 'w') as f:
-                json.dump(config_data, f, indent=4)
+            self._write_config()
         except Exception as e:
             # Use status bar for this error if available, less intrusive
             if hasattr(self, 'status_var'):
@@ -257,6 +544,26 @@ class DictationApp:
             else:
                 messagebox.showerror("Config Save Error", f"Could not save config: {e}")
 
+    def _write_config(self):
+        # Plain file I/O with no Tk calls, so on_closing can run it on a worker thread.
+        config_text = config_dumps({"settings": self.settings, "api_stats": self.api_stats})
+        if config_text == self.last_saved_config_text:
+            return
+        # Write a temp file and swap it in, so a crash mid-write can't leave a truncated config.
+        temp_path = CONFIG_FILE + ".tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f: # Explicit, since orjson emits non-ASCII text as-is
+            f.write(config_text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, CONFIG_FILE)
+        self.last_saved_config_text = config_text
+
+    def _write_config_on_exit(self):
+        try:
+            self._write_config()
+        except Exception as e:
+            print(f"Error saving config on exit: {e}")
+
     def setup_ui(self):
         main_frame = ttk.Frame(self.root, padding=PAD_XL)
         main_frame.pack(expand=True, fill=tk.BOTH)
@@ -301,21 +608,19 @@ class DictationApp:
 
         s = ttk.Style()
         try:
-            bg_color = s.lookup('TEntry', 'fieldbackground')
-            fg_color = s.lookup('TEntry', 'foreground')
-            insert_color = fg_color
-            try:
-                insert_color_lookup = s.lookup('TEntry', 'insertcolor')
-                if insert_color_lookup: insert_color = insert_color_lookup
-            except tk.TclError: pass
-
-            self.prompt_text.configure(bg=bg_color, fg=fg_color, insertbackground=insert_color)
+            # Each lookup is a Tcl round-trip, so fetch the entry colors once.
+            entry_colors = {option: s.lookup('TEntry', option) for option in ('fieldbackground', 'foreground', 'insertcolor')}
+            self.prompt_text.configure(
+                bg=entry_colors['fieldbackground'], fg=entry_colors['foreground'],
+                insertbackground=entry_colors['insertcolor'] or entry_colors['foreground']
+            )
 
             if self.is_themed_app:
                 prompt_outer_frame.configure(padding=1)
                 try: prompt_outer_frame.configure(style="Editor.TFrame")
                 except tk.TclError:
-                    if not s.layout("TFrame") or "borderwidth" not in s.layout("TFrame")[0][1]:
+                    frame_layout = s.layout("TFrame")
+                    if not frame_layout or "borderwidth" not in frame_layout[0][1]:
                         prompt_outer_frame.configure(relief="sunken", borderwidth=1)
             else: # Non-themed app
                 prompt_outer_frame.configure(style="InputArea.TFrame", padding=0)
@@ -325,6 +630,12 @@ class DictationApp:
             self.prompt_text.configure(relief=tk.SOLID, borderwidth=1) # Fallback border
         current_row += 1
 
+        self.paste_via_clipboard_var = tk.BooleanVar()
+        ttk.Checkbutton(
+            main_frame, text="Insert text by pasting from the clipboard (faster than typing)", variable=self.paste_via_clipboard_var
+        ).grid(row=current_row, column=1, sticky=tk.W, pady=(0, PAD_M))
+        current_row += 1
+
         stats_frame = ttk.LabelFrame(main_frame, text="API Usage Stats", padding=PAD_L)
         stats_frame.grid(row=current_row, column=0, columnspan=2, sticky=tk.EW, pady=(PAD_L, PAD_M))
         self.daily_calls_var = tk.StringVar()
@@ -375,6 +686,7 @@ class DictationApp:
         self.model_var.set(current_model)
         self.prompt_text.delete(1.0, tk.END)
         self.prompt_text.insert(tk.END, self.settings.get("prompt", DEFAULT_PROMPT))
+        self.paste_via_clipboard_var.set(self.settings.get("paste_via_clipboard", True))
         self.update_api_stats_display()
 
     def update_api_stats_display(self):
@@ -386,24 +698,22 @@ class DictationApp:
         self.settings["api_key"] = new_api_key
         self.settings["model"] = self.model_var.get()
         self.settings["prompt"] = self.prompt_text.get(1.0, tk.END).strip()
+        self.settings["paste_via_clipboard"] = self.paste_via_clipboard_var.get()
         self.save_config()
+        self.model_cache.clear() # Models keep the client (and API key) they were first used with
+        self._invalidate_prompt_cache()
         messagebox.showinfo("Settings Saved", "Settings have been saved.")
         self.apply_api_key_and_start_listener(new_api_key)
 
     def apply_api_key_and_start_listener(self, api_key_to_apply):
         if api_key_to_apply:
-            try:
-                genai.configure(api_key=api_key_to_apply)
-                self.status_var.set(f"Status: Ready. Press {FIXED_HOTKEY} to dictate.")
-                if not self.hotkey_listener_active:
-                    self.start_hotkey_listener_thread()
-            except Exception as e:
-                self.status_var.set(f"Status: API Key Error. Check settings: {e}")
-                messagebox.showerror("API Key Error", f"Failed to configure Gemini API: {e}")
-                self.stop_hotkey_listener_thread()
+            # The SDK itself is configured with the new key on first use, off the Tk thread (see _configured_genai).
+            self.configured_api_key = None
+            self.status_var.set(f"Status: Ready. Press {FIXED_HOTKEY} to dictate.")
+            if not self.hotkey_listener_active:
+                self.start_hotkey_listener()
         else:
-            self.status_var.set("Status: API Key missing. Dictation disabled.")
-            self.stop_hotkey_listener_thread()
+            self.stop_hotkey_listener() # Also sets the "API Key missing" status
 
     def increment_api_call(self):
         today_str = str(date.today())
@@ -413,29 +723,50 @@ class DictationApp:
         self.api_stats["daily_calls"] = self.api_stats.get("daily_calls", 0) + 1
         self.api_stats["total_calls"] = self.api_stats.get("total_calls", 0) + 1
         self.update_api_stats_display()
-        self.save_config()
+        self.schedule_save_config()
 
     def audio_callback(self, indata, frames, time_info, status):
         if status: print(status, flush=True)
-        if self.is_recording: self.audio_frames.append(indata.copy())
+        if not self.is_recording: return
+        # Plain copy into the preallocated buffer: no allocation on the real-time audio thread.
+        pos = self.audio_buffer_pos
+        n = min(frames, self.audio_buffer.shape[0] - pos)
+        if AUDIO_CHANNELS == 1:
+            self.audio_buffer[pos:pos + n] = np.frombuffer(indata, dtype=np.float32, count=n)
+        else:
+            samples = np.frombuffer(indata, dtype=np.float32, count=n * AUDIO_CHANNELS).reshape(n, AUDIO_CHANNELS)
+            np.mean(samples, axis=1, out=self.audio_buffer[pos:pos + n])
+        self.audio_buffer_pos = pos + n
+        if n and self.audio_buffer_pos == self.audio_buffer.shape[0]:
+            # Buffer just filled up: stop and transcribe what we have rather than silently dropping the rest.
+            print(f"Note: Reached the {MAX_RECORDING_SECONDS} s recording limit. Stopping.")
+            self.root.after(0, self._stop_full_recording)
+
+    def _stop_full_recording(self):
+        if self.is_recording: # The user may already have stopped it themselves
+            self.toggle_dictation_mode()
 
     def toggle_dictation_mode(self):
         if not self.settings.get("api_key"):
             self.root.after(0, lambda: self.status_var.set("Status: API Key missing."))
-            self.root.after(0, lambda: messagebox.showwarning("API Key Missing", "Please set your Google API Key in settings."))
+            self._report_error("API Key Missing", "Please set your Google API Key in settings.", dialog=messagebox.showwarning)
             return
 
         if not self.is_recording:
+            self.audio_buffer = np.empty(SAMPLE_RATE * MAX_RECORDING_SECONDS, dtype=np.float32)
+            self.audio_buffer_pos = 0
             self.is_recording = True
-            self.audio_frames = []
             self.play_sound_async(self.start_sound_obj)
             self.root.after(0, lambda: self.status_var.set("Status: Recording..."))
             try:
-                self.audio_stream = sd.InputStream(samplerate=16000, channels=1, callback=self.audio_callback, dtype='float32')
+                self.audio_stream = _sd().RawInputStream(
+                    samplerate=SAMPLE_RATE, channels=AUDIO_CHANNELS, dtype='float32', blocksize=AUDIO_BLOCKSIZE,
+                    latency='low', extra_settings=input_stream_extra_settings(), callback=self.audio_callback
+                )
                 self.audio_stream.start()
             except Exception as e:
                 self.is_recording = False
-                self.root.after(0, lambda: self.status_var.set(f"Status: Audio Error - {e}"))
+                self.root.after(0, self.status_var.set, f"Status: Audio Error - {e}")
                 messagebox.showerror("Audio Error", f"Could not start audio recording: {e}")
                 if self.audio_stream:
                     try:
@@ -457,137 +788,252 @@ class DictationApp:
                 finally:
                     self.audio_stream = None
 
-            if not self.audio_frames:
+            # The processing thread takes ownership of this buffer; the next recording allocates a new one.
+            recorded_audio = self.audio_buffer[:self.audio_buffer_pos]
+            self.audio_buffer = None
+            if recorded_audio.size == 0:
                 self.root.after(0, lambda: self.status_var.set(f"Status: No audio recorded. Press {FIXED_HOTKEY}."))
                 return
 
-            processing_thread = threading.Thread(target=self.process_recorded_audio_data_thread, daemon=True)
+            processing_thread = threading.Thread(target=self.process_recorded_audio_data_thread, args=(recorded_audio,), daemon=True)
             processing_thread.start()
 
-    def process_recorded_audio_data_thread(self):
-        current_audio_frames_copy = list(self.audio_frames)
-        self.audio_frames = []
-
-        if not current_audio_frames_copy:
-            self.root.after(0, lambda: self.status_var.set(f"Status: No audio data. Press {FIXED_HOTKEY}."))
-            return
+    def process_recorded_audio_data_thread(self, audio_data_1d):
+        uploaded_file = None
         try:
-            audio_data_raw = np.concatenate(current_audio_frames_copy, axis=0)
-            audio_data_float = audio_data_raw.astype(np.float32)
-            audio_data_1d = audio_data_float[:, 0] if audio_data_float.ndim > 1 and audio_data_float.shape[1] >= 1 else audio_data_float.flatten()
-            audio_data_to_send = audio_data_1d
-
-            if len(audio_data_to_send) > 800: # Min samples for filter
-                cutoff_hz, nyquist_rate = 100.0, 16000 / 2.0
-                if cutoff_hz < nyquist_rate:
-                    normalized_cutoff = cutoff_hz / nyquist_rate
-                    if 0 < normalized_cutoff < 1:
-                        try:
-                            b, a = signal.butter(4, normalized_cutoff, btype='highpass', analog=False)
-                            audio_data_to_send = signal.lfilter(b, a, audio_data_to_send)
-                        except Exception as filter_e:
-                            print(f"Warning: High-pass filter failed: {filter_e}")
-
-            if len(audio_data_to_send) == 0:
-                self.root.after(0, lambda: self.status_var.set(f"Status: Audio data too short. Press {FIXED_HOTKEY}."))
+            # Cheap checks first, so accidental double-taps and silence never reach the filter or the API.
+            if audio_data_1d.size < SAMPLE_RATE * MIN_SPEECH_SECONDS:
+                self.root.after(0, lambda: self.status_var.set(f"Status: Recording too short. Press {FIXED_HOTKEY}."))
+                return
+            mean_power = float(np.dot(audio_data_1d, audio_data_1d)) / audio_data_1d.size
+            if mean_power < 10.0 ** (SILENT_RECORDING_DBFS / 10.0):
+                self.root.after(0, lambda: self.status_var.set(f"Status: No speech detected. Press {FIXED_HOTKEY}."))
                 return
 
-            wav_io = io.BytesIO()
-            sf.write(wav_io, audio_data_to_send, 16000, format='WAV', subtype='PCM_16')
-            wav_io.seek(0)
-            audio_blob = {'mime_type': 'audio/wav', 'data': wav_io.read()}
+            try:
+                audio_data_to_send = apply_highpass_filter(audio_data_1d)
+            except Exception as filter_e:
+                print(f"Warning: High-pass filter failed: {filter_e}")
+                audio_data_to_send = audio_data_1d
+
+            audio_data_to_send = trim_silence(audio_data_to_send)
+            if len(audio_data_to_send) < SAMPLE_RATE * MIN_SPEECH_SECONDS:
+                self.root.after(0, lambda: self.status_var.set(f"Status: No speech detected. Press {FIXED_HOTKEY}."))
+                return
+
+            wav_bytes = encode_wav_pcm16(audio_data_to_send)
+            if len(audio_data_to_send) >= SAMPLE_RATE * INLINE_AUDIO_MAX_SECONDS:
+                # Uploading sends the WAV raw instead of base64-encoded inside the request body.
+                self.root.after(0, lambda: self.status_var.set("Status: Uploading audio..."))
+                uploaded_file = self._configured_genai().upload_file(io.BytesIO(wav_bytes), mime_type='audio/wav')
+                audio_part = uploaded_file
+            else:
+                audio_part = {'mime_type': 'audio/wav', 'data': wav_bytes}
 
             model_name_to_use = self.settings.get("model", DEFAULT_MODEL_CHOICE)
-            model = genai.GenerativeModel(model_name_to_use)
             prompt_to_use = self.settings.get("prompt", DEFAULT_PROMPT)
+            self._configured_genai()
+            prompt_cache = self._get_prompt_cache(model_name_to_use, prompt_to_use)
 
             self.root.after(0, lambda: self.status_var.set(f"Status: Transcribing with {model_name_to_use}..."))
-            response = model.generate_content([prompt_to_use, audio_blob], request_options={"timeout": 120})
-            self.increment_api_call()
+            # The request runs on the shared asyncio loop; this thread is done once it's submitted.
+            future = asyncio.run_coroutine_threadsafe(
+                self._generate_transcription(model_name_to_use, prompt_to_use, prompt_cache, audio_part), self.async_loop
+            )
+            future.add_done_callback(lambda f: self._on_transcription_done(f, uploaded_file))
+        except Exception as e:
+            error_info = traceback.format_exc()
+            self.root.after(0, self.status_var.set, f"Status: Error - {str(e)[:100]}... Check console.")
+            print(f"Error during audio processing: {e}\n{error_info}")
+            if uploaded_file is not None:
+                threading.Thread(target=self._delete_uploaded_file, args=(uploaded_file.name,), daemon=True).start()
+            if not self.is_recording:
+                self.root.after(200, lambda: self.status_var.set(f"Status: Ready. Press {FIXED_HOTKEY}."))
+
+    def _on_transcription_done(self, future, uploaded_file):
+        # Runs on the asyncio loop thread; all UI work is marshalled to Tk with root.after.
+        if uploaded_file is not None:
+            threading.Thread(target=self._delete_uploaded_file, args=(uploaded_file.name,), daemon=True).start()
+        try:
+            response = future.result()
+            self.root.after(0, self.increment_api_call)
 
             transcribed_text = ""
             if response.candidates and response.candidates[0].content.parts:
                 transcribed_text = response.candidates[0].content.parts[0].text.strip()
 
             if transcribed_text:
-                self.root.after(0, lambda: self.status_var.set("Status: Transcribed! Typing..."))
-                time.sleep(0.05) # Shorter delay
-                pyautogui.typewrite(transcribed_text + " ", interval=0.005) # Faster typing
+                if self.settings.get("paste_via_clipboard", True):
+                    self.root.after(0, lambda: self.status_var.set("Status: Transcribed! Pasting..."))
+                    self.root.after(0, self.paste_text, transcribed_text + " ")
+                else:
+                    self.root.after(0, lambda: self.status_var.set("Status: Transcribed! Typing..."))
+                    threading.Thread(target=self.type_text, args=(transcribed_text + " ",), daemon=True).start()
                 self.root.after(100, lambda: self.status_var.set(f"Status: Ready. Press {FIXED_HOTKEY}."))
             else:
                 feedback_msg = "Status: No text transcribed."
-                if hasattr(response, 'prompt_feedback') and response.prompt_feedback and response.prompt_feedback.block_reason:
-                    feedback_msg += f" Reason: {response.prompt_feedback.block_reason_message or response.prompt_feedback.block_reason}"
-                elif hasattr(response, 'prompt_feedback') and response.prompt_feedback and response.prompt_feedback.safety_ratings:
-                    for rating in response.prompt_feedback.safety_ratings:
-                        if rating.blocked:
-                            feedback_msg += f" Blocked: {rating.category.name} ({rating.probability.name})."
-                            break
+                prompt_feedback = getattr(response, 'prompt_feedback', None)
+                if prompt_feedback and prompt_feedback.block_reason:
+                    feedback_msg += f" Reason: {prompt_feedback.block_reason_message or prompt_feedback.block_reason}"
+                elif prompt_feedback and prompt_feedback.safety_ratings:
+                    blocked = next((r for r in prompt_feedback.safety_ratings if getattr(r, 'blocked', False)), None)
+                    if blocked:
+                        feedback_msg += f" Blocked: {blocked.category.name} ({blocked.probability.name})."
                 self.root.after(0, lambda: self.status_var.set(feedback_msg))
-        except genai.types.generation_types.StopCandidateException as sce:
-            self.root.after(0, lambda: self.status_var.set(f"Status: Transcription stopped by API. {sce}"))
+        except _genai().types.generation_types.StopCandidateException as sce:
+            self.root.after(0, self.status_var.set, f"Status: Transcription stopped by API. {sce}")
             print(f"StopCandidateException: {sce}")
             if hasattr(sce, 'response') and sce.response.prompt_feedback: print(f"Prompt Feedback: {sce.response.prompt_feedback}")
         except Exception as e:
             error_info = traceback.format_exc()
-            self.root.after(0, lambda: self.status_var.set(f"Status: Error - {str(e)[:100]}... Check console."))
-            print(f"Error during processing or transcription: {e}\n{error_info}")
+            self.root.after(0, self.status_var.set, f"Status: Error - {str(e)[:100]}... Check console.")
+            print(f"Error during transcription: {e}\n{error_info}")
         finally:
             if not self.is_recording:
                 self.root.after(200, lambda: self.status_var.set(f"Status: Ready. Press {FIXED_HOTKEY}."))
 
-    def _actual_hotkey_listener_loop(self):
-        print(f"Hotkey listener started for '{FIXED_HOTKEY}'.")
+    def type_text(self, text):
+        time.sleep(0.05) # Shorter delay
+        _pyautogui().typewrite(text, interval=0.005) # Faster typing
+
+    def paste_text(self, text):
+        # Pastes text into the focused application via the clipboard. Must run on the Tk thread.
+        try:
+            previous_clipboard = self.root.clipboard_get()
+        except tk.TclError:
+            previous_clipboard = None # Empty or non-text clipboard
+        self.root.clipboard_clear()
+        self.root.clipboard_append(text)
+        keyboard.send(PASTE_HOTKEY)
+        if previous_clipboard is not None:
+            self.root.after(CLIPBOARD_RESTORE_DELAY_MS, self._restore_clipboard, previous_clipboard)
+
+    def _restore_clipboard(self, previous_clipboard):
+        self.root.clipboard_clear()
+        self.root.clipboard_append(previous_clipboard)
+
+    async def _generate_transcription(self, model_name, prompt, prompt_cache, audio_part):
+        if prompt_cache is not None:
+            try:
+                model = self.model_cache.get(prompt_cache.name)
+                if model is None:
+                    model = self.model_cache[prompt_cache.name] = _genai().GenerativeModel.from_cached_content(prompt_cache)
+                return await model.generate_content_async([audio_part], request_options={"timeout": 120})
+            except (google_exceptions.NotFound, google_exceptions.PermissionDenied, google_exceptions.FailedPrecondition) as e:
+                # Typically the cache expired or was removed server-side; send the prompt inline this time.
+                print(f"Note: Cached prompt rejected ({e}). Retrying without cache.")
+                self._invalidate_prompt_cache()
+        model = self.model_cache.get((model_name, prompt))
+        if model is None:
+            model = self.model_cache[(model_name, prompt)] = _genai().GenerativeModel(model_name, system_instruction=prompt)
+        return await model.generate_content_async([audio_part], request_options={"timeout": 120})
+
+    def _get_prompt_cache(self, model_name, prompt):
+        # Returns cached content holding the system prompt, or None to send the prompt inline. Never waits on
+        # the network: a missing or stale cache is created on a background thread and picked up by a later dictation.
+        key = (model_name, prompt)
+        with self.prompt_cache_lock:
+            cache_age = time.monotonic() - self.prompt_cache_created
+            if (self.prompt_cache is not None and self.prompt_cache_key == key
+                    and cache_age < PROMPT_CACHE_TTL_SECONDS - PROMPT_CACHE_REFRESH_MARGIN_SECONDS):
+                return self.prompt_cache
+            if (len(prompt) < PROMPT_CACHE_MIN_PROMPT_CHARS or key == self.prompt_cache_failed_key
+                    or key == self.prompt_cache_pending_key):
+                return None
+            self.prompt_cache_pending_key = key
+        threading.Thread(target=self._create_prompt_cache, args=(key,), daemon=True).start()
+        return None
+
+    def _create_prompt_cache(self, key):
+        model_name, prompt = key
+        created = time.monotonic()
         try:
-            try: keyboard.remove_hotkey(FIXED_HOTKEY)
-            except: pass
-            keyboard.add_hotkey(FIXED_HOTKEY, self.toggle_dictation_mode, suppress=False)
-            self.hotkey_listener_active = True
-            while self.hotkey_listener_active:
-                time.sleep(0.1)
-        except ImportError:
-            self.root.after(0, lambda: messagebox.showerror("Hotkey Error", "Keyboard library missing. Hotkey disabled."))
-            self.hotkey_listener_active = False
+            new_cache = _genai().caching.CachedContent.create(
+                model=model_name, system_instruction=prompt, ttl=timedelta(seconds=PROMPT_CACHE_TTL_SECONDS)
+            )
         except Exception as e:
-            print(f"Error in hotkey listener thread for '{FIXED_HOTKEY}': {e}")
-            self.root.after(0, lambda: messagebox.showerror("Hotkey Error", f"Could not set hotkey '{FIXED_HOTKEY}': {e}\nTry running as admin."))
-            self.hotkey_listener_active = False
-        finally:
-            if 'keyboard' in sys.modules:
-                try: keyboard.remove_hotkey(FIXED_HOTKEY)
-                except Exception as e: print(f"Note: Error removing hotkey '{FIXED_HOTKEY}' on loop exit: {e}")
-            print(f"Hotkey listener loop for '{FIXED_HOTKEY}' has ended.")
+            # Caching needs a minimum prompt size and a model version that supports it.
+            print(f"Note: Prompt caching unavailable for '{model_name}': {e}")
+            with self.prompt_cache_lock:
+                if self.prompt_cache_pending_key == key:
+                    self.prompt_cache_pending_key = None
+                    self.prompt_cache_failed_key = key # Not retried until the model or prompt changes
+            return
+        with self.prompt_cache_lock:
+            if self.prompt_cache_pending_key == key:
+                self.prompt_cache_pending_key = None
+                stale_cache = self.prompt_cache
+                self.prompt_cache = new_cache
+                self.prompt_cache_key = key
+                self.prompt_cache_created = created
+            else:
+                stale_cache = new_cache # Invalidated (settings saved or app closing) while it was being created
+        if stale_cache is not None:
+            self._delete_prompt_cache(stale_cache)
+
+    def _invalidate_prompt_cache(self):
+        # Drops the current prompt cache and deletes it server-side. Returns the deleting thread, if any.
+        with self.prompt_cache_lock:
+            stale_cache = self.prompt_cache
+            self.prompt_cache = None
+            self.prompt_cache_key = None
+            self.prompt_cache_pending_key = None
+        if stale_cache is None:
+            return None
+        # Daemon, so a stalled request can't keep the process alive; a cache left behind expires with its TTL.
+        delete_thread = threading.Thread(target=self._delete_prompt_cache, args=(stale_cache,), daemon=True)
+        delete_thread.start()
+        return delete_thread
 
-    def start_hotkey_listener_thread(self):
-        if self.hotkey_listener_active and self.hotkey_listener_thread and self.hotkey_listener_thread.is_alive():
+    def _delete_prompt_cache(self, prompt_cache):
+        self.model_cache.pop(prompt_cache.name, None)
+        try:
+            prompt_cache.delete()
+        except Exception as e:
+            print(f"Note: Could not delete cached prompt: {e}")
+
+    def _delete_uploaded_file(self, file_name):
+        try:
+            _genai().delete_file(file_name)
+        except Exception as e:
+            print(f"Note: Could not delete uploaded audio '{file_name}': {e}")
+
+    def start_hotkey_listener(self):
+        if self.hotkey_listener_active:
             return
         if not self.settings.get("api_key"):
             self.status_var.set("Status: API Key required to start listener.")
             return
-        self.hotkey_listener_thread = threading.Thread(target=self._actual_hotkey_listener_loop, daemon=True)
-        self.hotkey_listener_thread.start()
-        self.root.after(200, self._check_hotkey_listener_status)
-
-    def _check_hotkey_listener_status(self):
-        if not (self.hotkey_listener_active and self.hotkey_listener_thread and self.hotkey_listener_thread.is_alive()):
-            if self.settings.get("api_key"):
+        # keyboard dispatches hotkeys from its own hook thread, so no listener thread of ours is needed.
+        # The hotkey is registered once and stays registered until on_closing; stopping just disables it.
+        if not self.hotkey_registered:
+            try:
+                keyboard.add_hotkey(FIXED_HOTKEY, self._on_hotkey, suppress=False)
+                self.hotkey_registered = True
+            except Exception as e:
+                print(f"Error registering hotkey '{FIXED_HOTKEY}': {e}")
                 self.status_var.set("Status: Hotkey listener failed. Check console/run as admin.")
+                self._report_error("Hotkey Error", f"Could not set hotkey '{FIXED_HOTKEY}': {e}\nTry running as admin.")
+                return
+        self.hotkey_listener_active = True
+        print(f"Hotkey listener started for '{FIXED_HOTKEY}'.")
 
-    def stop_hotkey_listener_thread(self):
+    def _on_hotkey(self):
+        # Runs on keyboard's hook thread; the toggle itself happens on the Tk thread.
         if self.hotkey_listener_active:
-            self.hotkey_listener_active = False
-            if self.hotkey_listener_thread and self.hotkey_listener_thread.is_alive():
-                self.hotkey_listener_thread.join(timeout=0.2) # Shorter join
-        self.hotkey_listener_thread = None
-        if not self.settings.get("api_key"):
-            self.status_var.set("Status: API Key missing. Dictation disabled.")
-        elif not self.hotkey_listener_active:
-            self.status_var.set(f"Status: Hotkey listener stopped. Configure API Key and Save to restart.")
+            self.root.after(0, self.toggle_dictation_mode)
+
+    def stop_hotkey_listener(self):
+        self.hotkey_listener_active = False
+        status_msg = ("Status: API Key missing. Dictation disabled." if not self.settings.get("api_key")
+                      else "Status: Hotkey listener stopped. Configure API Key and Save to restart.")
+        self.status_var.set(status_msg)
 
     # --- SYSTEM TRAY METHODS ---
     def _get_icon_image(self):
         try:
             image = Image.open(ICON_PATH)
+            image.load() # Decode fully now so the file handle is closed and later uses don't touch the disk
             return image
         except FileNotFoundError:
             print(f"Warning: Icon file '{ICON_PATH}' not found. Creating placeholder.")
@@ -608,22 +1054,21 @@ class DictationApp:
 
     def quit_action(self, icon=None, item=None):
         self.is_quitting_via_tray = True
-        if self.can_use_tray and self.tray_icon:
-             self.tray_icon.stop()
-        self.root.after(0, self.on_closing)
+        self.root.after(0, self.on_closing) # on_closing owns all teardown, including stopping the tray
 
     def show_window(self):
-        self.root.deiconify()
-        self.root.lift()
-        self.root.attributes("-topmost", True)
-        self.root.after(100, lambda: self.root.attributes("-topmost", False))
-        self.root.focus_force()
-
-    def hide_to_tray(self):
-        if self.is_quitting_via_tray:
-            self.on_closing()
-        else:
-            self.root.withdraw()
+        # Deiconify, raise, pin on top and focus in a single Tcl evaluation instead of one call each.
+        # -topmost is dropped again in _clear_topmost_once, as soon as focus actually lands. The foreground
+        # lock can refuse focus -force from the tray, so a timer (and hiding the window) also clear it.
+        w = self.root._w
+        self.topmost_until_focus = True
+        self.root.tk.eval(f"wm deiconify {w}; raise {w}; wm attributes {w} -topmost 1; focus -force {w}")
+        self.root.after(TOPMOST_FALLBACK_MS, self._clear_topmost_once)
+
+    def _clear_topmost_once(self, event=None):
+        if self.topmost_until_focus:
+            self.topmost_until_focus = False
+            self.root.attributes("-topmost", False)
 
     def setup_tray_icon(self):
         if not self.can_use_tray: return
@@ -650,42 +1095,59 @@ class DictationApp:
 
     def on_closing(self):
         print("Closing application (on_closing called)...")
-        is_actual_quit = self.is_quitting_via_tray
 
-        if not self.can_use_tray:
-            is_actual_quit = True
-        elif not self.is_quitting_via_tray and self.root.winfo_exists() and self.root.winfo_viewable():
-             print("Window 'X' clicked, but hide_to_tray should manage. If this appears, review logic.")
-             return
+        # The final save runs on its own thread, overlapping the disk write with the rest of the teardown.
+        print("Saving configuration...")
+        if self.pending_save_id is not None:
+            self.root.after_cancel(self.pending_save_id)
+            self.pending_save_id = None
+        save_thread = threading.Thread(target=self._write_config_on_exit, daemon=False)
+        save_thread.start()
 
+        prompt_cache_thread = self._invalidate_prompt_cache()
+        if prompt_cache_thread is not None:
+            print("Deleting cached prompt...")
 
         if self.can_use_tray and self.tray_icon:
             print("Stopping tray icon...")
             self.tray_icon.stop()
+            # Wait for run() to return so the native icon and its message window are released before exit.
+            if self.tray_thread and self.tray_thread.is_alive() and self.tray_thread is not threading.current_thread():
+                self.tray_thread.join(timeout=2.0)
+            self.tray_icon = None
+            self.tray_thread = None
 
         print("Stopping hotkey listener...")
-        self.stop_hotkey_listener_thread()
-
-        if self.is_recording and self.audio_stream:
-            self.is_recording = False
-            print("Stopping active audio stream...")
+        self.stop_hotkey_listener()
+        if self.hotkey_registered:
+            # Drop every keyboard hook, not just ours, so nothing can call back into the root once it's destroyed.
+            try: keyboard.unhook_all()
+            except Exception as e: print(f"Note: Error removing keyboard hooks: {e}")
+            self.hotkey_registered = False
+
+        if self.audio_stream is not None:
+            self.is_recording = False # Lets the callback return immediately while the stream shuts down
+            print("Closing active audio stream...")
             try:
-                if self.audio_stream and not self.audio_stream.closed:
-                    self.audio_stream.stop()
-                    self.audio_stream.close()
-                    print("Audio stream stopped and closed.")
+                # close() aborts an active stream itself; a separate stop() would first wait for it to drain.
+                self.audio_stream.close(ignore_errors=True)
+                print("Audio stream closed.")
             except Exception as e:
                 print(f"Error closing audio stream on exit: {e}")
-            self.audio_stream = None
+            finally:
+                self.audio_stream = None
 
-        print("Saving configuration...")
-        self.save_config()
+        self.async_loop.call_soon_threadsafe(self.async_loop.stop)
 
-        if PYGAME_MIXER_AVAILABLE:
+        if PYGAME_MIXER_AVAILABLE and pygame.mixer.get_init() is not None:
             print("Quitting pygame mixer...")
             pygame.mixer.quit()
             print("Pygame mixer quit.")
 
+        save_thread.join(timeout=1.0) # If it's still writing, the non-daemon thread finishes before the process exits
+        if prompt_cache_thread is not None:
+            prompt_cache_thread.join(timeout=1.0) # Gives the delete a chance to finish before the daemon thread is dropped
+
         if self.root.winfo_exists():
             print("Destroying Tkinter root window...")
             self.root.destroy()
@@ -722,7 +1184,8 @@ if __name__ == "__main__":
         root.mainloop()
     except KeyboardInterrupt:
         print("\nKeyboardInterrupt caught. Closing application...")
-        app.quit_action()
+        app.is_quitting_via_tray = True
+        app.on_closing() # Called directly: mainloop has exited, so quit_action's root.after would never run
     finally:
         if app and not app.is_quitting_via_tray:
              if hasattr(app, 'on_closing') and callable(app.on_closing):